@@ -26,6 +26,11 @@ def create_app(config_name='default'):
     app = Flask(__name__, template_folder='templates', static_folder='static')
     app.config.from_object(config[config_name])
     
+    # Use orjson for JSON encoding/decoding when it is installed
+    from app.utils.json_provider import OrjsonProvider, orjson
+    if orjson is not None:
+        app.json = OrjsonProvider(app)
+    
     # Add custom Jinja2 filters
     @app.template_filter('datetime')
     def datetime_filter(timestamp):
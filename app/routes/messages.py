@@ -16,7 +16,7 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
-from flask import Blueprint, request, jsonify, Response, current_app, render_template
+from flask import Blueprint, request, jsonify, Response, current_app, render_template, make_response
 from app.utils.letta_client import LettaClient
 from app.utils.session_manager import get_user_id, get_user_tag_id
 from app.utils.validators import filter_messages, convert_to_ai_sdk_message
@@ -49,7 +49,10 @@ def get_agent_messages(agent_id):
         
         # Check if this is an HTMX request
         if request.headers.get('HX-Request'):
-            return render_template('components/messages_list.html', messages=converted_messages)
+            # ETag the rendered list so polls of an unchanged conversation get a 304
+            response = make_response(render_template('components/messages_list.html', messages=converted_messages))
+            response.add_etag()
+            return response.make_conditional(request)
         else:
             return jsonify(converted_messages)
     except Exception as e:
@@ -16,11 +16,20 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+from itertools import islice
 from flask_wtf import FlaskForm
 from wtforms import StringField, TextAreaField, SelectField, FieldList, FormField, SubmitField
 from wtforms.validators import DataRequired, Length, Optional
 from wtforms.widgets import TextArea
 
+# Allowed values, built once so validation is a set lookup
+VALID_MODELS = frozenset({
+    'letta/letta-free', 'letta/letta-pro',
+    'openai/gpt-4', 'openai/gpt-3.5-turbo',
+    'anthropic/claude-3-sonnet', 'anthropic/claude-3-haiku'
+})
+VALID_ROLES = frozenset({'user', 'assistant', 'system'})
+
 class MemoryBlockForm(FlaskForm):
     """Form for individual memory block"""
     label = StringField('Label', validators=[DataRequired(), Length(max=50)])
@@ -50,70 +59,68 @@ class MessageForm(FlaskForm):
                           render_kw={'rows': 3, 'placeholder': 'Type your message...'})
     submit = SubmitField('Send')
 
-def validate_agent_data(data):
-    """Validate agent data from API requests"""
-    errors = []
-    
+def _agent_data_errors(data):
+    """Yield agent data validation errors in order"""
     # Validate name
     if 'name' in data:
         name = data['name']
         if not isinstance(name, str):
-            errors.append('Name must be a string')
+            yield 'Name must be a string'
         elif len(name) > 100:
-            errors.append('Name must be less than 100 characters')
+            yield 'Name must be less than 100 characters'
     
     # Validate model
     if 'model' in data:
         model = data['model']
-        valid_models = [
-            'letta/letta-free', 'letta/letta-pro',
-            'openai/gpt-4', 'openai/gpt-3.5-turbo',
-            'anthropic/claude-3-sonnet', 'anthropic/claude-3-haiku'
-        ]
-        if model not in valid_models:
-            errors.append(f'Invalid model: {model}')
+        # Checked as a string first, as unhashable values can't be looked up in a set
+        if not isinstance(model, str) or model not in VALID_MODELS:
+            yield f'Invalid model: {model}'
     
     # Validate memory blocks
     if 'memoryBlocks' in data:
         memory_blocks = data['memoryBlocks']
         if not isinstance(memory_blocks, list):
-            errors.append('Memory blocks must be a list')
+            yield 'Memory blocks must be a list'
         else:
             for i, block in enumerate(memory_blocks):
                 if not isinstance(block, dict):
-                    errors.append(f'Memory block {i} must be a dictionary')
+                    yield f'Memory block {i} must be a dictionary'
                 elif 'label' not in block or 'value' not in block:
-                    errors.append(f'Memory block {i} must have label and value')
+                    yield f'Memory block {i} must have label and value'
                 elif not isinstance(block['label'], str) or len(block['label']) > 50:
-                    errors.append(f'Memory block {i} label must be a string less than 50 characters')
+                    yield f'Memory block {i} label must be a string less than 50 characters'
                 elif not isinstance(block['value'], str) or len(block['value']) > 1000:
-                    errors.append(f'Memory block {i} value must be a string less than 1000 characters')
-    
-    return errors
+                    yield f'Memory block {i} value must be a string less than 1000 characters'
 
-def validate_message_data(data):
-    """Validate message data from API requests"""
-    errors = []
-    
+def _message_data_errors(data):
+    """Yield message data validation errors in order"""
     if 'messages' not in data:
-        errors.append('Messages field is required')
+        yield 'Messages field is required'
     else:
         messages = data['messages']
         if not isinstance(messages, list):
-            errors.append('Messages must be a list')
+            yield 'Messages must be a list'
         elif len(messages) == 0:
-            errors.append('At least one message is required')
+            yield 'At least one message is required'
         else:
             for i, message in enumerate(messages):
                 if not isinstance(message, dict):
-                    errors.append(f'Message {i} must be a dictionary')
+                    yield f'Message {i} must be a dictionary'
                 elif 'role' not in message or 'content' not in message:
-                    errors.append(f'Message {i} must have role and content')
-                elif message['role'] not in ['user', 'assistant', 'system']:
-                    errors.append(f'Message {i} has invalid role: {message["role"]}')
+                    yield f'Message {i} must have role and content'
+                elif not isinstance(message['role'], str) or message['role'] not in VALID_ROLES:
+                    yield f'Message {i} has invalid role: {message["role"]}'
                 elif not isinstance(message['content'], str):
-                    errors.append(f'Message {i} content must be a string')
+                    yield f'Message {i} content must be a string'
                 elif len(message['content']) > 4000:
-                    errors.append(f'Message {i} content must be less than 4000 characters')
-    
-    return errors
+                    yield f'Message {i} content must be less than 4000 characters'
+
+def validate_agent_data(data, first_error_only=False):
+    """Validate agent data from API requests, stopping at the first error if first_error_only"""
+    errors = _agent_data_errors(data)
+    return list(islice(errors, 1) if first_error_only else errors)
+
+def validate_message_data(data, first_error_only=False):
+    """Validate message data from API requests, stopping at the first error if first_error_only"""
+    errors = _message_data_errors(data)
+    return list(islice(errors, 1) if first_error_only else errors)
@@ -0,0 +1,46 @@
+"""
+Letta Chatbot - orjson-backed JSON Provider
+Copyright (C) 2025 Mark Hopkins
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU Affero General Public License as published
+by the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU Affero General Public License for more details.
+
+You should have received a copy of the GNU Affero General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, Flask's default provider is used without it
+    orjson = None
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON provider using orjson for jsonify() and request/response get_json()"""
+    
+    def dumps(self, obj, **kwargs):
+        """Serialize obj to a JSON string"""
+        if kwargs.keys() - {'indent', 'separators'}:
+            # Options orjson has no equivalent for, passed on untouched
+            return super().dumps(obj, **kwargs)
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        # Datetimes go through default() so they keep Flask's HTTP date format
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+    
+    def loads(self, s, **kwargs):
+        """Deserialize a JSON string or bytes"""
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
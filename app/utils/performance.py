@@ -17,128 +17,156 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 from flask import current_app
-from functools import wraps
+from functools import wraps, lru_cache, _make_key
+from collections import OrderedDict
 import time
-import hashlib
-import json
+import threading
+import weakref
 
 # Simple in-memory cache (in production, use Redis or Memcached)
-_cache = {}
-_cache_ttl = {}
+# Every cache_result-wrapped function, so caches can be cleared by name
+_cached_functions = weakref.WeakSet()
 
-def cache_result(ttl=300, key_prefix=''):
-    """Decorator to cache function results"""
+def cache_result(ttl=300, key_prefix='', maxsize=1024):
+    """Decorator to cache function results for ttl seconds"""
     def decorator(f):
+        cached = lru_cache(maxsize=maxsize)(f)
+        # Expiry times in the same least-recently-used order as the lru_cache,
+        # so both evict the same key and hold the same entries
+        expiry = OrderedDict()
+        
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            # Generate cache key
-            cache_key = f"{key_prefix}:{f.__name__}:{hashlib.md5(str(args).encode() + str(kwargs).encode()).hexdigest()}"
-            
-            # Check if cached result exists and is not expired
-            if cache_key in _cache:
-                if time.time() - _cache_ttl.get(cache_key, 0) < ttl:
-                    current_app.logger.debug(f"Cache hit for {cache_key}")
-                    return _cache[cache_key]
-                else:
-                    # Remove expired cache entry
-                    del _cache[cache_key]
-                    del _cache_ttl[cache_key]
+            try:
+                # Same key lru_cache builds, so an unhashable argument fails here
+                key = _make_key(args, kwargs, False)
+            except TypeError:
+                return f(*args, **kwargs)
             
-            # Execute function and cache result
-            result = f(*args, **kwargs)
-            _cache[cache_key] = result
-            _cache_ttl[cache_key] = time.time()
+            now = time.monotonic()
+            expires = expiry.get(key)
+            if expires is not None and expires <= now:
+                # lru_cache can't drop a single entry, so start over
+                decorated_function.cache_clear()
+                expires = None
             
-            current_app.logger.debug(f"Cached result for {cache_key}")
+            result = cached(*args, **kwargs)
+            if expires is None:
+                expiry[key] = now + ttl
+                if maxsize is not None and len(expiry) > maxsize:
+                    expiry.popitem(last=False)
+                current_app.logger.debug(f"Cached result for {decorated_function.cache_name}")
+            else:
+                expiry.move_to_end(key)
             return result
         
+        def cache_clear():
+            cached.cache_clear()
+            expiry.clear()
+        
+        def cache_stats():
+            now = time.monotonic()
+            return len(expiry), sum(1 for expires in expiry.values() if expires <= now)
+        
+        decorated_function.cache_name = f"{key_prefix}:{f.__name__}"
+        decorated_function.cache_clear = cache_clear
+        decorated_function.cache_stats = cache_stats
+        _cached_functions.add(decorated_function)
         return decorated_function
     return decorator
 
 def invalidate_cache(pattern=None):
-    """Invalidate cache entries matching pattern"""
+    """Invalidate cached results of functions whose cache name matches pattern"""
     if pattern is None:
-        _cache.clear()
-        _cache_ttl.clear()
+        clear_all_cache()
         return
     
-    keys_to_remove = [key for key in _cache.keys() if pattern in key]
-    for key in keys_to_remove:
-        del _cache[key]
-        del _cache_ttl[key]
+    invalidated = [f for f in list(_cached_functions) if pattern in f.cache_name]
+    for f in invalidated:
+        f.cache_clear()
     
-    current_app.logger.debug(f"Invalidated {len(keys_to_remove)} cache entries matching '{pattern}'")
+    current_app.logger.debug(f"Invalidated {len(invalidated)} caches matching '{pattern}'")
 
 def clear_all_cache():
     """Clear all cache entries"""
-    _cache.clear()
-    _cache_ttl.clear()
+    for f in list(_cached_functions):
+        f.cache_clear()
 
 def reset_rate_limiters():
     """Reset all rate limiters"""
-    global api_rate_limiter, message_rate_limiter
-    api_rate_limiter.requests.clear()
-    message_rate_limiter.requests.clear()
+    api_rate_limiter.reset()
+    message_rate_limiter.reset()
 
 def get_cache_stats():
     """Get cache statistics"""
-    total_entries = len(_cache)
+    total_entries = 0
     expired_entries = 0
-    
-    current_time = time.time()
-    for key, timestamp in _cache_ttl.items():
-        if current_time - timestamp > 300:  # 5 minutes default TTL
-            expired_entries += 1
+    for f in list(_cached_functions):
+        entries, expired = f.cache_stats()
+        total_entries += entries
+        expired_entries += expired
     
     return {
         'total_entries': total_entries,
         'expired_entries': expired_entries,
-        'active_entries': total_entries - expired_entries,
-        'cache_size_mb': sum(len(str(v).encode()) for v in _cache.values()) / 1024 / 1024
+        'active_entries': total_entries - expired_entries
     }
 
+# Power of two, so the shard is picked with a mask
+RATE_LIMIT_SHARDS = 16
+
 class RateLimiter:
-    """Simple rate limiter using sliding window"""
+    """Token bucket rate limiter, bursting up to max_requests and refilling them over the window"""
     
-    def __init__(self, max_requests=100, window_seconds=60):
+    def __init__(self, max_requests=100, window_seconds=60, time_fn=time.monotonic):
         self.max_requests = max_requests
         self.window_seconds = window_seconds
-        self.requests = {}
+        self.refill_rate = max_requests / window_seconds
+        self.time_fn = time_fn
+        # identifier -> (tokens, last refill time), striped over shards so
+        # different identifiers rarely wait on the same lock
+        self._shards = tuple((dict(), threading.Lock()) for _ in range(RATE_LIMIT_SHARDS))
+        self._shard_mask = RATE_LIMIT_SHARDS - 1
+    
+    def _shard(self, identifier):
+        """Get the buckets and lock holding an identifier"""
+        return self._shards[hash(identifier) & self._shard_mask]
+    
+    def _tokens(self, buckets, identifier, now):
+        """Get the tokens an identifier has at time now"""
+        tokens, last_refill = buckets.get(identifier, (self.max_requests, now))
+        return min(self.max_requests, tokens + (now - last_refill) * self.refill_rate)
     
     def is_allowed(self, identifier):
         """Check if request is allowed for given identifier"""
-        current_time = time.time()
-        window_start = current_time - self.window_seconds
-        
-        # Clean old requests
-        if identifier in self.requests:
-            self.requests[identifier] = [
-                req_time for req_time in self.requests[identifier] 
-                if req_time > window_start
-            ]
-        else:
-            self.requests[identifier] = []
-        
-        # Check if under limit
-        if len(self.requests[identifier]) < self.max_requests:
-            self.requests[identifier].append(current_time)
-            return True
-        
-        return False
+        # Hot path: shard lookup and refill are inlined (same math as _tokens),
+        # with the clock and rates bound to locals once per call
+        buckets, lock = self._shards[hash(identifier) & self._shard_mask]
+        now_fn = self.time_fn
+        capacity = self.max_requests
+        refill_rate = self.refill_rate
+        with lock:
+            now = now_fn()
+            tokens, last_refill = buckets.get(identifier, (capacity, now))
+            tokens += (now - last_refill) * refill_rate
+            if tokens > capacity:
+                tokens = capacity
+            if tokens >= 1:
+                buckets[identifier] = (tokens - 1, now)
+                return True
+            buckets[identifier] = (tokens, now)
+            return False
     
     def get_remaining_requests(self, identifier):
         """Get remaining requests for identifier"""
-        current_time = time.time()
-        window_start = current_time - self.window_seconds
-        
-        if identifier in self.requests:
-            self.requests[identifier] = [
-                req_time for req_time in self.requests[identifier] 
-                if req_time > window_start
-            ]
-            return max(0, self.max_requests - len(self.requests[identifier]))
-        
-        return self.max_requests
+        buckets, _ = self._shard(identifier)
+        return int(self._tokens(buckets, identifier, self.time_fn()))
+    
+    def reset(self):
+        """Forget all identifiers"""
+        for buckets, lock in self._shards:
+            with lock:
+                buckets.clear()
 
 # Global rate limiter instances
 api_rate_limiter = RateLimiter(max_requests=200, window_seconds=60)  # 200 requests per minute
@@ -16,11 +16,13 @@ You should have received a copy of the GNU Affero General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import time
 import uuid
 from flask import session, request, current_app
-from datetime import datetime, timedelta, timezone
+from datetime import datetime
 
 LETTA_UID = 'letta_uid'
+CREATED_AT_TS = 'created_at_ts'
 SESSION_TIMEOUT = 24 * 60 * 60  # 24 hours in seconds
 
 def get_user_id():
@@ -43,7 +45,7 @@ def get_user_id():
         if not user_id:
             user_id = str(uuid.uuid4())
             session[LETTA_UID] = user_id
-            session['created_at'] = datetime.now(timezone.utc).isoformat()
+            session[CREATED_AT_TS] = time.time()
             session.permanent = True
         
         # Check session timeout
@@ -52,7 +54,7 @@ def get_user_id():
             session.clear()
             user_id = str(uuid.uuid4())
             session[LETTA_UID] = user_id
-            session['created_at'] = datetime.now(timezone.utc).isoformat()
+            session[CREATED_AT_TS] = time.time()
             session.permanent = True
         
         return user_id
@@ -63,6 +65,16 @@ def get_user_id():
             return current_app._test_user_id
         return None  # Return None instead of fallback
 
+def _session_created_at():
+    """Get the session creation time as a UNIX timestamp, or None if unknown"""
+    created_at = session.get(CREATED_AT_TS)
+    if created_at is None:
+        # Sessions from before timestamps were stored as floats keep an ISO string
+        legacy_created_at = session.get('created_at')
+        if legacy_created_at:
+            created_at = datetime.fromisoformat(legacy_created_at).timestamp()
+    return created_at
+
 def is_session_expired():
     """Check if session has expired"""
     if not current_app.config['USE_COOKIE_BASED_AUTHENTICATION']:
@@ -73,12 +85,11 @@ def is_session_expired():
         return False  # In tests, consider session as not expired
     
     try:
-        created_at = session.get('created_at')
-        if not created_at:
+        created_at = _session_created_at()
+        if created_at is None:
             return True
         
-        created_time = datetime.fromisoformat(created_at)
-        return datetime.now(timezone.utc) - created_time > timedelta(seconds=SESSION_TIMEOUT)
+        return time.time() - created_at > SESSION_TIMEOUT
     except (ValueError, TypeError, RuntimeError, AttributeError):
         # Handle case where session is not available (e.g., in tests)
         if current_app.config.get('TESTING'):
@@ -126,15 +137,14 @@ def get_session_info():
     
     try:
         user_id = session.get(LETTA_UID)
-        created_at = session.get('created_at')
         
         session_age = 0
-        if created_at:
-            try:
-                created_time = datetime.fromisoformat(created_at)
-                session_age = (datetime.now(timezone.utc) - created_time).total_seconds()
-            except (ValueError, TypeError):
-                pass
+        try:
+            created_at = _session_created_at()
+            if created_at is not None:
+                session_age = time.time() - created_at
+        except (ValueError, TypeError):
+            pass
         
         return {
             'user_id': user_id,
@@ -59,7 +59,7 @@ def run_integration_tests():
 def run_e2e_tests():
     """Run end-to-end tests"""
     return run_command(
-        "python -m pytest tests/test_e2e.py -v --tb=short",
+        "python -m pytest tests/test_e2e.py -m e2e -n auto --maxfail=1 -v --tb=short",
         "End-to-End Tests"
     )
 
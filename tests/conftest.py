@@ -1,9 +1,84 @@
 import os
+import re
+import sys
+import json
+import functools
+import threading
 import pytest
-from unittest.mock import patch
+from contextlib import contextmanager
+from pathlib import Path
+from types import MappingProxyType
+from unittest.mock import patch, Mock, MagicMock
+from flask import session
 from app import create_app
 from app.config import config
 from playwright.sync_api import sync_playwright
+from _pytest.mark.expression import Expression, ParseError
+
+LETTA_FIXTURES_DIR = Path(__file__).parent / 'fixtures' / 'letta'
+LETTA_FIXTURES_MODE = os.environ.get('LETTA_FIXTURES_MODE', 'replay')
+E2E_HOST = '127.0.0.1'
+STATIC_ASSET_PATTERN = '**/*.{js,css,woff2,png,svg}'
+# Chromium features the E2E tests never exercise, images included
+CHROMIUM_ARGS = (
+    '--no-sandbox',
+    '--disable-dev-shm-usage',
+    '--blink-settings=imagesEnabled=false',
+    '--disable-background-networking',
+    '--disable-sync',
+    '--disable-translate',
+    '--disable-default-apps',
+)
+
+# Raw Letta messages stored column-wise, including a system message that should be filtered
+MESSAGE_FIELDS = ('id', 'message_type', 'content', 'date')
+MESSAGE_COLUMNS = (
+    ('msg-1', 'msg-2', 'msg-3'),
+    ('user_message', 'system_message', 'assistant_message'),
+    ('Hello', 'System message', 'Hi there!'),
+    (1640995200000, 1640995210000, 1640995220000)
+)
+
+def _letta_sdk_stub():
+    """Stand-in for the letta_client SDK, behaving like an unreachable server"""
+    stub = MagicMock(name='letta_client')
+    stub.Letta.side_effect = ConnectionError('Letta SDK is stubbed out in unit tests')
+    return stub
+
+def _selects_marker(markexpr, marker):
+    """Check whether a -m expression asks for tests with the given marker
+
+    That is, the expression matches a test carrying only that marker but
+    not an unmarked one, so "not integration" or an "integration_slow"
+    marker don't count.
+    """
+    try:
+        expression = Expression.compile(markexpr)
+    except ParseError:
+        # pytest reports the bad expression itself
+        return False
+    return expression.evaluate(lambda name: name == marker) and not expression.evaluate(lambda name: False)
+
+def pytest_configure(config):
+    """Keep the real Letta SDK out of unit test runs
+
+    Routes are patched per test anyway, so importing the SDK only costs
+    start-up time. Runs selecting integration tests (-m integration) keep
+    the real SDK.
+    """
+    config.addinivalue_line('markers', 'e2e: browser-driven tests, skipped unless selected with -m e2e')
+    config.addinivalue_line('markers', 'integration: tests using the real Letta SDK against recorded HTTP fixtures')
+    if not _selects_marker(config.getoption('markexpr') or '', 'integration'):
+        sys.modules.setdefault('letta_client', _letta_sdk_stub())
+
+def pytest_collection_modifyitems(config, items):
+    """Skip browser-driven tests unless a run selects them with -m e2e"""
+    if _selects_marker(config.getoption('markexpr') or '', 'e2e'):
+        return
+    skip_e2e = pytest.mark.skip(reason='browser-driven test, run with -m e2e')
+    for item in items:
+        if item.get_closest_marker('e2e'):
+            item.add_marker(skip_e2e)
 
 @pytest.fixture(autouse=True)
 def clear_global_state():
@@ -16,9 +91,13 @@ def clear_global_state():
     clear_all_cache()
     reset_rate_limiters()
 
-@pytest.fixture
-def app():
-    """Create test application"""
+@pytest.fixture(scope='session')
+def shared_app():
+    """Create test application once per session
+
+    Under pytest-xdist every worker is its own process, so each worker
+    gets its own app along with its own caches and rate limiters.
+    """
     app = create_app('testing')
     app.config.update({
         'TESTING': True,
@@ -29,23 +108,52 @@ def app():
         'SECRET_KEY': 'test-secret-key',
         'SESSION_TYPE': 'null'  # Use null session for testing
     })
+    if LETTA_FIXTURES_MODE == 'record':
+        # Recording needs a real Letta server
+        app.config.update({
+            'LETTA_API_KEY': os.environ['LETTA_API_KEY'],
+            'LETTA_BASE_URL': os.environ['LETTA_BASE_URL']
+        })
     return app
 
+@pytest.fixture
+def app(shared_app):
+    """Test application, with config and test user restored after each test"""
+    config_snapshot = dict(shared_app.config)
+    yield shared_app
+    shared_app.config.clear()
+    shared_app.config.update(config_snapshot)
+    if hasattr(shared_app, '_test_user_id'):
+        delattr(shared_app, '_test_user_id')
+
 @pytest.fixture
 def client(app):
     """Create test client"""
     return app.test_client()
 
+@pytest.fixture(scope='module')
+def shared_client(shared_app):
+    """Test client reused by every test in a module"""
+    return shared_app.test_client()
+
 @pytest.fixture
-def client_with_session(app):
-    """Create test client with session"""
-    client = app.test_client()
+def client_with_session(app, shared_client):
+    """Test client with session, reset at the start of each test"""
+    with shared_client.session_transaction() as sess:
+        sess.clear()
     # Set the test user ID on the app
     app._test_user_id = 'test-user-123'
-    yield client
-    # Clean up
-    if hasattr(app, '_test_user_id'):
-        delattr(app, '_test_user_id')
+    return shared_client
+
+@pytest.fixture
+def session_ctx(app):
+    """Factory for request contexts whose session already holds the given keys"""
+    @contextmanager
+    def make_ctx(**session_data):
+        with app.test_request_context():
+            session.update(session_data)
+            yield session
+    return make_ctx
 
 @pytest.fixture
 def client_no_session(app):
@@ -58,47 +166,98 @@ def client_no_session(app):
     if hasattr(app, '_test_user_id'):
         delattr(app, '_test_user_id')
 
-@pytest.fixture
-def mock_letta_responses():
-    """Mock Letta API responses"""
-    return {
-        'agents': [
-            {
-                'id': 'agent-1',
-                'name': 'Test Agent 1',
-                'model': 'letta/letta-free',
-                'tags': ['user:test-user-123'],
-                'updatedAt': 1640995200000,
-                'memoryBlocks': [
-                    {'label': 'persona', 'value': 'I am a test agent'}
-                ]
-            }
-        ],
-        'messages': [
-            {
-                'id': 'msg-1',
-                'message_type': 'user_message',
-                'content': 'Hello, test message',
-                'date': 1640995200000
-            },
-            {
-                'id': 'msg-2', 
-                'message_type': 'assistant_message',
-                'content': 'Hello! How can I help you?',
-                'date': 1640995260000
-            }
-        ],
-        'agent_details': {
-            'id': 'agent-1',
-            'name': 'Test Agent 1',
-            'model': 'letta/letta-free',
-            'tags': ['user:test-user-123'],
-            'memoryBlocks': [
-                {'label': 'persona', 'value': 'I am a test agent'},
-                {'label': 'human', 'value': 'The human is a tester'}
-            ]
+@functools.lru_cache(maxsize=None)
+def _read_fixture(name):
+    """Read a recorded Letta API fixture once per session"""
+    return (LETTA_FIXTURES_DIR / name).read_text()
+
+def load_fixture(name):
+    """Load the response body of a recorded Letta API fixture"""
+    return json.loads(_read_fixture(name))['response']['json']
+
+def _forward_to_letta(request):
+    """Send an intercepted SDK request to the real Letta server"""
+    import httpx
+    import requests
+    real_response = requests.request(request.method, str(request.url),
+                                     headers=dict(request.headers), data=request.content)
+    return httpx.Response(real_response.status_code, content=real_response.content,
+                          headers={'Content-Type': real_response.headers.get('Content-Type', 'application/json')})
+
+def _record_fixtures(calls):
+    """Write real Letta API responses back to the fixture files"""
+    existing = {}
+    for path in LETTA_FIXTURES_DIR.glob('*.json'):
+        request = json.loads(path.read_text())['request']
+        existing[(request['method'], request['path'])] = path
+    
+    for request, response in calls:
+        key = (request.method, request.url.path)
+        default_name = re.sub(r'[^a-z0-9]+', '_', f'{request.method} {request.url.path}'.lower()).strip('_')
+        path = existing.get(key, LETTA_FIXTURES_DIR / f'{default_name}.json')
+        fixture = {
+            'request': {'method': request.method, 'path': request.url.path},
+            'response': {'status_code': response.status_code, 'json': response.json()}
         }
-    }
+        path.write_text(json.dumps(fixture, indent=2) + '\n')
+    
+    _read_fixture.cache_clear()
+
+@pytest.fixture(scope='session')
+def letta_api_fixtures():
+    """Replay recorded Letta API responses for tests using the real SDK
+
+    With LETTA_FIXTURES_MODE=record, requests go to the real Letta server
+    and the responses are written back to tests/fixtures/letta/. In replay
+    mode (the default) any request without a fixture fails the test.
+    """
+    respx = pytest.importorskip('respx')
+    if isinstance(sys.modules.get('letta_client'), MagicMock):
+        pytest.skip('Letta SDK is stubbed out; run with -m integration')
+    
+    if LETTA_FIXTURES_MODE == 'record':
+        with respx.mock(assert_all_called=False) as router:
+            router.route().mock(side_effect=_forward_to_letta)
+            yield router
+            _record_fixtures(router.calls)
+        return
+    
+    with respx.mock(base_url=config['testing'].LETTA_BASE_URL, assert_all_called=False) as router:
+        for path in sorted(LETTA_FIXTURES_DIR.glob('*.json')):
+            fixture = json.loads(_read_fixture(path.name))
+            request, response = fixture['request'], fixture['response']
+            router.route(method=request['method'], path=request['path']).respond(
+                response['status_code'], json=response['json']
+            )
+        yield router
+
+@pytest.fixture(scope='module')
+def mock_letta_responses():
+    """Mock Letta API responses, loaded from the recorded fixtures"""
+    # Read-only, as the responses are shared by every test in a module
+    return MappingProxyType({
+        'agents': load_fixture('agents_list.json'),
+        'messages': load_fixture('messages_list.json'),
+        'agent_details': load_fixture('agent_details.json')
+    })
+
+@pytest.fixture
+def mock_letta(monkeypatch):
+    """Letta client mock behind the agents and messages routes, listing nothing by default"""
+    # Imported here so the SDK stub from pytest_configure is already in place
+    from app.utils.letta_client import LettaClient
+    # Spec'd so a call to a method LettaClient lacks fails loudly
+    mock_instance = Mock(spec=LettaClient)
+    mock_instance.list_agents.return_value = []
+    mock_instance.list_messages.return_value = []
+    monkeypatch.setattr('app.routes.agents.LettaClient', lambda *args, **kwargs: mock_instance)
+    monkeypatch.setattr('app.routes.messages.LettaClient', lambda *args, **kwargs: mock_instance)
+    return mock_instance
+
+@pytest.fixture(scope='module')
+def raw_messages():
+    """Raw Letta messages built from MESSAGE_COLUMNS, shared by every test in a module"""
+    return tuple(MappingProxyType(dict(zip(MESSAGE_FIELDS, row))) for row in zip(*MESSAGE_COLUMNS))
 
 @pytest.fixture
 def sample_agent_data():
@@ -112,7 +271,7 @@ def sample_agent_data():
         ]
     }
 
-@pytest.fixture
+@pytest.fixture(scope='module')
 def sample_message_data():
     """Sample message data for testing"""
     return {
@@ -124,10 +283,97 @@ def sample_message_data():
         ]
     }
 
+@pytest.fixture(scope='module')
+def sample_message_body(sample_message_data):
+    """sample_message_data serialized once, for posting in loops"""
+    return json.dumps(sample_message_data).encode()
+
+@pytest.fixture(scope='session')
+def e2e_app(shared_app):
+    """App served to the browser: the test app, but issuing real session cookies
+
+    In TESTING mode get_user_id() returns the test user without touching
+    the session, so a browser would never get a session cookie.
+    """
+    app = create_app('testing')
+    app.config.update(shared_app.config)
+    app.config['TESTING'] = False
+    return app
+
+@pytest.fixture(scope='session')
+def base_url(e2e_app):
+    """Serve the E2E app for browser-driven tests and return its URL
+
+    Runs waitress with 8 threads in a background thread, so concurrent
+    browser requests aren't serialized and LettaClient patches made by a
+    test apply to the server. The server binds a free port, so xdist
+    workers never collide and tests never run against another app.
+    """
+    waitress = pytest.importorskip('waitress')
+    # The socket is bound and listening once the server is created
+    server = waitress.create_server(e2e_app, host=E2E_HOST, port=0, threads=8)
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    yield f'http://{E2E_HOST}:{server.effective_port}'
+    server.close()
+
 @pytest.fixture(scope="session")
-def browser():
+def browser(base_url):
     """Browser fixture for E2E tests"""
     with sync_playwright() as p:
-        browser = p.chromium.launch(headless=True)
+        browser = p.chromium.launch(headless=True, args=list(CHROMIUM_ARGS))
         yield browser
         browser.close()
+
+@pytest.fixture(scope='session')
+def new_context(browser):
+    """Factory for browser contexts serving static assets from memory after their first fetch"""
+    static_assets = {}
+    
+    def serve_static_asset(route):
+        url = route.request.url
+        if url not in static_assets:
+            response = route.fetch()
+            static_assets[url] = {'status': response.status, 'headers': response.headers, 'body': response.body()}
+        route.fulfill(**static_assets[url])
+    
+    def factory(**kwargs):
+        context = browser.new_context(**kwargs)
+        context.route(STATIC_ASSET_PATTERN, serve_static_asset)
+        return context
+    
+    return factory
+
+@pytest.fixture
+def page(new_context):
+    """Playwright page in a fresh browser context, so no cookies or storage carry over"""
+    context = new_context()
+    page = context.new_page()
+    yield page
+    context.close()
+
+@pytest.fixture(scope='session')
+def warm_session_state(new_context, base_url):
+    """Storage state (cookies and local storage) of a warmed-up app session
+
+    Warming up means loading the app once and waiting for the agents list,
+    which creates the session. It happens once per test session and is
+    deliberately not saved between runs: the cookie is only valid for the
+    SECRET_KEY and session layout of the run that signed it, and one page
+    load is cheaper than keeping a shared snapshot valid across runs.
+    """
+    context = new_context()
+    page = context.new_page()
+    with page.expect_response(lambda response: '/api/agents-list' in response.url):
+        page.goto(base_url, wait_until='domcontentloaded')
+    storage_state = context.storage_state()
+    context.close()
+    return storage_state
+
+@pytest.fixture
+def warm_page(new_context, warm_session_state):
+    """Playwright page in a browser context restored to the warmed-up session"""
+    context = new_context(storage_state=warm_session_state)
+    page = context.new_page()
+    yield page
+    context.close()
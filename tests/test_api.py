@@ -1,21 +1,4 @@
-import pytest
 import json
-from app import create_app
-
-@pytest.fixture
-def app():
-    """Create test app"""
-    app = create_app('development')
-    app.config['TESTING'] = True
-    app.config['LETTA_API_KEY'] = 'test-key'
-    app.config['LETTA_BASE_URL'] = 'http://test-letta-server'
-    app.config['USE_COOKIE_BASED_AUTHENTICATION'] = False
-    return app
-
-@pytest.fixture
-def client(app):
-    """Create test client"""
-    return app.test_client()
 
 def test_runtime_endpoint(client):
     """Test runtime info endpoint"""
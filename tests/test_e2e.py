@@ -1,32 +1,31 @@
 import pytest
-import json
 import time
-from unittest.mock import patch, MagicMock
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.chrome.options import Options
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch, Mock
+from app.utils.letta_client import LettaClient
+
+# HTMX is loaded and has no request in flight
+HTMX_IDLE = "() => !!window.htmx && !document.querySelector('.htmx-request')"
+
+# Selectors for the main page
+AGENTS_LIST = '#agents-list'
+SIDEBAR = '#sidebar'
+CREATE_BTN = '[data-id="create-agent-button"]'
+AGENT_ITEM = '.agent-item'
+AGENT_DETAILS = '#agent-details'
+MOBILE_MENU = 'button[onclick="toggleMobileSidebar()"]'
+# Message input and submit button, matched in document order
+MESSAGE_COMPOSER = '#message-input, #message-form button[type="submit"]'
 
 class TestEndToEndWorkflows:
     """Test suite for complete user journey testing"""
     
-    @pytest.fixture(scope='class')
-    def browser(self):
-        """Set up browser for E2E testing"""
-        options = Options()
-        options.add_argument('--headless')  # Run in headless mode for CI
-        options.add_argument('--no-sandbox')
-        options.add_argument('--disable-dev-shm-usage')
-        
-        driver = webdriver.Chrome(options=options)
-        yield driver
-        driver.quit()
-    
-    def test_complete_user_journey_create_and_chat(self, browser, client_with_session):
+    @pytest.mark.e2e
+    def test_complete_user_journey_create_and_chat(self, page, base_url):
         """Test complete user journey: visit site -> create agent -> chat"""
         with patch('app.routes.agents.LettaClient') as mock_client:
-            mock_instance = MagicMock()
+            mock_instance = Mock(spec=LettaClient)
             mock_client.return_value = mock_instance
             
             # Mock successful agent creation
@@ -54,211 +53,216 @@ class TestEndToEndWorkflows:
                 'content': 'Hello! How can I help you?'
             }
             
-            # Start Flask app for E2E testing
-            app = client_with_session.application
-            
             # Navigate to the application
-            browser.get('http://localhost:5000')
+            page.goto(base_url, wait_until='domcontentloaded')
             
             # Wait for page to load
-            WebDriverWait(browser, 10).until(
-                EC.presence_of_element_located((By.ID, 'agents-list'))
-            )
+            page.wait_for_selector(AGENTS_LIST, state='attached')
             
             # Wait for sidebar to be visible (on desktop it should be visible by default)
-            WebDriverWait(browser, 10).until(
-                EC.visibility_of_element_located((By.ID, 'sidebar'))
-            )
+            page.wait_for_selector(SIDEBAR, state='visible')
             
             # Check if create agent button is present and visible
-            create_button = WebDriverWait(browser, 10).until(
-                EC.presence_of_element_located((By.CSS_SELECTOR, '[data-id="create-agent-button"]'))
-            )
+            create_button = page.locator(CREATE_BTN)
+            create_button.wait_for(state='attached')
             
-            # Wait a bit more for HTMX to load
-            time.sleep(2)
+            # Wait for HTMX to load
+            page.wait_for_function(HTMX_IDLE, timeout=5000)
             
             # Check if button is clickable
             assert create_button.is_enabled(), "Create agent button is not enabled"
             
-            # Scroll to button to ensure it's visible
-            browser.execute_script("arguments[0].scrollIntoView(true);", create_button)
-            time.sleep(1)
-            
-            # Click create agent button using JavaScript
-            browser.execute_script("arguments[0].click();", create_button)
+            # Scroll to button and click it with a DOM click event
+            create_button.scroll_into_view_if_needed()
+            create_button.dispatch_event('click')
             
             # Wait for agent to be created and appear in list
-            WebDriverWait(browser, 10).until(
-                EC.presence_of_element_located((By.CSS_SELECTOR, '.agent-item'))
-            )
+            page.wait_for_selector(AGENT_ITEM, state='attached')
             
             # Verify agent appears in sidebar
-            agent_items = browser.find_elements(By.CSS_SELECTOR, '.agent-item')
-            assert len(agent_items) > 0
+            agent_items = page.locator(AGENT_ITEM)
+            assert agent_items.count() > 0
             
-            # Click on the first agent using JavaScript
-            browser.execute_script("arguments[0].click();", agent_items[0])
+            # Click on the first agent with a DOM click event
+            agent_items.first.dispatch_event('click')
             
             # Wait for agent details to load
-            WebDriverWait(browser, 10).until(
-                EC.presence_of_element_located((By.ID, 'agent-details'))
-            )
+            page.wait_for_selector(AGENT_DETAILS, state='attached')
             
-            # Check if message composer is present
-            message_input = browser.find_element(By.ID, 'message-input')
-            assert message_input.is_displayed()
+            # Check if message composer is present, input and submit button
+            # resolve from one compound selector in document order
+            composer = page.locator(MESSAGE_COMPOSER)
+            message_input, submit_button = composer.nth(0), composer.nth(1)
+            assert message_input.is_visible()
             
             # Type a message
-            message_input.send_keys('Hello, this is a test message')
+            message_input.fill('Hello, this is a test message')
             
             # Submit the message
-            submit_button = browser.find_element(By.CSS_SELECTOR, '#message-form button[type="submit"]')
             submit_button.click()
             
             # Wait for message to appear (this would require actual HTMX response)
-            # For now, just verify the form submission worked
-            assert message_input.get_attribute('value') == ''  # Should be cleared after submit
+            # For now, just verify the form submission worked: the input is
+            # cleared after submit, checked browser-side in one round trip
+            page.wait_for_function("() => document.getElementById('message-input').value === ''", timeout=5000)
     
-    def test_mobile_responsive_behavior(self, browser):
+    @pytest.mark.e2e
+    def test_mobile_responsive_behavior(self, warm_page, base_url):
         """Test mobile responsive behavior"""
         # Set mobile viewport
-        browser.set_window_size(375, 667)  # iPhone size
+        warm_page.set_viewport_size({'width': 375, 'height': 667})  # iPhone size
         
         # Navigate to app
-        browser.get('http://localhost:5000')
+        warm_page.goto(base_url, wait_until='domcontentloaded')
         
         # Check if mobile menu button is visible
-        mobile_menu = WebDriverWait(browser, 10).until(
-            EC.presence_of_element_located((By.CSS_SELECTOR, 'button[onclick="toggleMobileSidebar()"]'))
-        )
+        mobile_menu = warm_page.locator(MOBILE_MENU)
+        mobile_menu.wait_for(state='visible')
+        
+        # Wait for HTMX to load
+        warm_page.wait_for_function(HTMX_IDLE, timeout=5000)
         
-        # Wait a bit more for HTMX to load
-        time.sleep(2)
+        # Click mobile menu to open sidebar with a DOM click event
+        mobile_menu.dispatch_event('click')
         
-        # Click mobile menu to open sidebar using JavaScript
-        browser.execute_script("arguments[0].click();", mobile_menu)
+        # Read sidebar and overlay state in one round trip
+        state = warm_page.evaluate("""() => ({
+            sidebarClasses: document.getElementById('sidebar').className,
+            overlayHidden: document.getElementById('mobile-overlay').classList.contains('hidden')
+        })""")
         
         # Check if sidebar is visible
-        sidebar = browser.find_element(By.ID, 'sidebar')
-        sidebar_classes = sidebar.get_attribute('class')
-        assert 'translate-x-0' in sidebar_classes, f"Sidebar should be visible, classes: {sidebar_classes}"
+        assert 'translate-x-0' in state['sidebarClasses'], f"Sidebar should be visible, classes: {state['sidebarClasses']}"
         
         # Check if overlay is present
-        overlay = browser.find_element(By.ID, 'mobile-overlay')
-        assert not overlay.get_attribute('class').split().__contains__('hidden')
+        assert not state['overlayHidden']
     
-    def test_error_handling_e2e(self, browser):
-        """Test error handling in E2E scenario"""
-        # Navigate to app
-        browser.get('http://localhost:5000')
+    def test_error_handling_e2e(self, client_with_session, monkeypatch):
+        """Test error handling for a non-existent agent, checked without a browser"""
+        letta_client = Mock(spec=LettaClient)
+        letta_client.get_agent.side_effect = Exception('Agent not found')
+        monkeypatch.setattr('app.utils.letta_client.LettaClient', lambda *args, **kwargs: letta_client)
         
         # Try to access non-existent agent
-        browser.get('http://localhost:5000/nonexistent-agent')
+        response = client_with_session.get('/nonexistent-agent')
         
-        # Check if error is handled gracefully
-        # (This would depend on how errors are displayed in the UI)
-        assert browser.current_url.endswith('nonexistent-agent')
+        # Check if error is handled gracefully with the 404 page
+        assert response.status_code == 404
     
-    def test_form_validation_e2e(self, browser):
+    @pytest.mark.e2e
+    def test_form_validation_e2e(self, warm_page, base_url):
         """Test form validation in E2E scenario"""
-        browser.get('http://localhost:5000')
+        warm_page.goto(base_url, wait_until='domcontentloaded')
         
-        # Find message input
-        message_input = browser.find_element(By.ID, 'message-input')
+        # Find message input and submit button
+        composer = warm_page.locator(MESSAGE_COMPOSER)
+        message_input, submit_button = composer.nth(0), composer.nth(1)
         
         # Try to submit empty message
-        submit_button = browser.find_element(By.CSS_SELECTOR, '#message-form button[type="submit"]')
         submit_button.click()
         
         # Check if validation prevents submission
         # (This would depend on client-side validation)
-        assert message_input.get_attribute('value') == ''
+        assert message_input.input_value() == ''
     
-    def test_session_persistence_e2e(self, browser):
+    @pytest.mark.e2e
+    def test_session_persistence_e2e(self, page, base_url, e2e_app):
         """Test session persistence across page refreshes"""
-        browser.get('http://localhost:5000')
+        serializer = e2e_app.session_interface.get_signing_serializer(e2e_app)
         
-        # Wait for page to load and session to be created
-        WebDriverWait(browser, 10).until(
-            EC.presence_of_element_located((By.ID, 'agents-list'))
-        )
+        def session_user_id():
+            # The cookie is re-signed on every request, so compare its contents
+            session_cookies = [c for c in page.context.cookies() if c['name'] == e2e_app.config['SESSION_COOKIE_NAME']]
+            assert len(session_cookies) > 0
+            return serializer.loads(session_cookies[0]['value'])['letta_uid']
         
-        # Refresh the page
-        browser.refresh()
+        # Loading the agents list creates the session
+        with page.expect_response(lambda response: '/api/agents-list' in response.url):
+            page.goto(base_url, wait_until='domcontentloaded')
+        user_id = session_user_id()
         
-        # Check if session persists (agents list should still load)
-        WebDriverWait(browser, 10).until(
-            EC.presence_of_element_located((By.ID, 'agents-list'))
-        )
+        # Refresh the page
+        with page.expect_response(lambda response: '/api/agents-list' in response.url):
+            page.reload(wait_until='domcontentloaded')
         
-        # Verify session cookie exists
-        cookies = browser.get_cookies()
-        session_cookies = [c for c in cookies if 'session' in c['name'].lower()]
-        assert len(session_cookies) > 0
+        # Check if session persists: still the same user
+        assert session_user_id() == user_id
 
 class TestPerformanceE2E:
     """Test suite for performance testing"""
     
-    def test_page_load_performance(self, browser):
-        """Test page load performance"""
-        import time
-        
-        start_time = time.time()
-        page = browser.new_page()
-        page.goto('http://localhost:5000')
-        
-        # Wait for page to be fully loaded
-        page.wait_for_load_state('networkidle')
-        
-        load_time = time.time() - start_time
-        
-        # Page should load within 5 seconds (more realistic for test environment)
-        assert load_time < 5.0, f"Page took {load_time:.2f}s to load, should be under 5s"
-        
-        page.close()
+    def test_page_load_performance(self, client_with_session):
+        """Test page render time, measured in-process without a browser"""
+        timings = []
+        for _ in range(50):
+            start_time = time.perf_counter()
+            response = client_with_session.get('/')
+            timings.append(time.perf_counter() - start_time)
+            assert response.status_code == 200
+        
+        # Median render time should stay well under 50ms
+        median_time = statistics.median(timings)
+        assert median_time < 0.05, f"Page took {median_time * 1000:.1f}ms to render, should be under 50ms"
     
-    def test_concurrent_user_simulation(self, browser):
+    def test_concurrent_user_simulation(self, app):
         """Test application behavior under concurrent users"""
-        # This would require multiple browser instances
-        # For now, just test that the app can handle multiple rapid requests
-        
-        page = browser.new_page()
-        page.goto('http://localhost:5000')
-        
-        # Simulate rapid interactions
-        for i in range(10):
-            page.reload()
-            page.wait_for_load_state('networkidle')
-        
-        # App should still be responsive
-        agents_list = page.locator('#agents-list').first
-        assert agents_list.is_visible()
-        
-        page.close()
+        def load_page(_):
+            # One client per simulated user, test clients keep their own cookies
+            start_time = time.perf_counter()
+            response = app.test_client().get('/')
+            return response.status_code, time.perf_counter() - start_time
+        
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            results = list(executor.map(load_page, range(50)))
+        
+        assert all(status == 200 for status, _ in results)
+        slowest = max(elapsed for _, elapsed in results)
+        assert slowest < 1.0, f"Slowest request took {slowest:.2f}s, should be under 1s"
+    
+    @pytest.mark.e2e
+    def test_concurrent_browser_contexts(self, new_context, base_url):
+        """Test several browser users loading the app at the same time"""
+        # Independent contexts have their own cookies, like separate users
+        contexts = [new_context() for _ in range(4)]
+        try:
+            pages = [context.new_page() for context in contexts]
+            # Start every navigation from the page itself, so the browser loads
+            # them concurrently instead of one blocking goto() after another
+            for page in pages:
+                page.evaluate("url => setTimeout(() => { location.href = url }, 0)", base_url)
+            
+            # Every user gets the agents list
+            for page in pages:
+                page.locator(AGENTS_LIST).wait_for(state='visible')
+        finally:
+            for context in contexts:
+                context.close()
 
+@pytest.mark.e2e
 class TestAccessibilityE2E:
     """Test suite for accessibility testing"""
     
-    def test_keyboard_navigation(self, browser):
+    @pytest.fixture(scope='class')
+    def page(self, new_context, base_url):
+        """One page shared by the class, as every test only inspects the main page"""
+        context = new_context()
+        page = context.new_page()
+        page.goto(base_url, wait_until='domcontentloaded')
+        page.wait_for_selector(AGENTS_LIST, state='visible')
+        yield page
+        context.close()
+    
+    def test_keyboard_navigation(self, page):
         """Test keyboard navigation"""
-        page = browser.new_page()
-        page.goto('http://localhost:5000')
-        
         # Tab through interactive elements
         page.keyboard.press('Tab')
         
         # Check if focus is visible
         focused_element = page.locator(':focus')
         assert focused_element.count() > 0
-        
-        page.close()
     
-    def test_screen_reader_compatibility(self, browser):
+    def test_screen_reader_compatibility(self, page):
         """Test screen reader compatibility"""
-        page = browser.new_page()
-        page.goto('http://localhost:5000')
-        
         # Check for basic HTML structure (buttons, inputs, etc.)
         interactive_elements = page.locator('button, input, textarea, select')
         assert interactive_elements.count() > 0, "Should have interactive elements"
@@ -266,17 +270,10 @@ class TestAccessibilityE2E:
         # Check for proper heading structure
         headings = page.locator('h1, h2, h3, h4, h5, h6')
         assert headings.count() > 0, "Should have proper heading structure"
-        
-        page.close()
     
-    def test_color_contrast(self, browser):
+    def test_color_contrast(self, page):
         """Test color contrast (basic check)"""
-        page = browser.new_page()
-        page.goto('http://localhost:5000')
-        
         # Check if dark mode toggle is present
         # (This would require checking actual color values)
         dark_mode_toggle = page.locator('#dark-mode-toggle')
         assert dark_mode_toggle.is_visible(), "Dark mode toggle should be visible"
-        
-        page.close()
@@ -1,61 +1,71 @@
 import pytest
+import gc
 import time
 import threading
-import requests
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from unittest.mock import patch, MagicMock
-from app.utils.performance import RateLimiter, cache_result, get_cache_stats
+import tracemalloc
+import orjson
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_EXCEPTION
+from unittest.mock import patch
+from app.utils.performance import RateLimiter, cache_result, get_cache_stats, api_rate_limiter
 from app.utils.forms import validate_agent_data, validate_message_data
 
+def _message_body(content):
+    """Request body for a single user message, pre-encoded with orjson"""
+    return orjson.dumps({'messages': [{'role': 'user', 'content': content}]})
+
+@pytest.fixture(scope='session')
+def large_agent_list():
+    """Large agent list, built once per test session"""
+    return tuple(
+        {
+            'id': f'agent-{i}',
+            'name': f'Test Agent {i}',
+            'model': 'letta/letta-free',
+            'tags': ['user:test-user-123'],
+            'updatedAt': 1640995200000 + i
+        }
+        for i in range(1000)
+    )
+
 class TestPerformanceTests:
     """Test suite for performance testing"""
     
-    def test_api_response_times(self, client_with_session):
+    def test_api_response_times(self, client_with_session, mock_letta):
         """Test API response times are within acceptable limits"""
-        with patch('app.routes.agents.LettaClient') as mock_client:
-            mock_instance = MagicMock()
-            mock_instance.list_agents.return_value = []
-            mock_client.return_value = mock_instance
-            
-            # Test agents list response time
-            start_time = time.time()
-            response = client_with_session.get('/api/agents')
-            response_time = time.time() - start_time
-            
-            assert response.status_code == 200
-            assert response_time < 1.0, f"API response took {response_time:.2f}s, should be under 1s"
+        # Test agents list response time
+        start_time = time.perf_counter()
+        response = client_with_session.get('/api/agents')
+        response_time = time.perf_counter() - start_time
+        
+        assert response.status_code == 200
+        assert response_time < 1.0, f"API response took {response_time:.2f}s, should be under 1s"
     
-    def test_concurrent_requests(self, client_with_session):
+    def test_concurrent_requests(self, client_with_session, mock_letta):
         """Test application handles concurrent requests properly"""
-        with patch('app.routes.agents.LettaClient') as mock_client:
-            mock_instance = MagicMock()
-            mock_instance.list_agents.return_value = []
-            mock_client.return_value = mock_instance
-            
-            def make_request():
-                return client_with_session.get('/api/agents')
-            
-            # Make 10 concurrent requests
-            with ThreadPoolExecutor(max_workers=10) as executor:
-                futures = [executor.submit(make_request) for _ in range(10)]
-                responses = [future.result() for future in as_completed(futures)]
-            
-            # All requests should succeed
-            assert all(r.status_code == 200 for r in responses)
-            
-            # Response times should be reasonable
-            for response in responses:
-                assert response.status_code == 200
+        def make_request():
+            return client_with_session.get('/api/agents')
+        
+        # Make 10 concurrent requests, returning as soon as any of them raises
+        executor = ThreadPoolExecutor(max_workers=10)
+        try:
+            futures = [executor.submit(make_request) for _ in range(10)]
+            done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+        finally:
+            # Not a with block: leaving it would wait for every running request
+            executor.shutdown(wait=False, cancel_futures=True)
+        responses = [future.result() for future in done]
+        
+        assert len(responses) == 10
+        
+        # All requests should succeed
+        assert all(r.status_code == 200 for r in responses)
+        
+        # Response times should be reasonable
+        for response in responses:
+            assert response.status_code == 200
     
     def test_memory_usage(self, app):
         """Test memory usage doesn't grow excessively"""
-        import psutil
-        import os
-        from unittest.mock import patch
-        
-        process = psutil.Process(os.getpid())
-        initial_memory = process.memory_info().rss
-        
         # Mock the Letta client to avoid actual API calls
         with patch('app.routes.agents.LettaClient') as mock_client:
             mock_instance = mock_client.return_value
@@ -66,15 +76,23 @@ class TestPerformanceTests:
                 # Set test user ID directly on app
                 app._test_user_id = 'test-user-123'
                 
-                for i in range(100):
-                    response = client.get('/api/agents')
-                    assert response.status_code == 200
+                tracemalloc.start()
+                try:
+                    # Collect first so only garbage from the requests is counted
+                    gc.collect()
+                    before = tracemalloc.take_snapshot()
+                    for i in range(100):
+                        response = client.get('/api/agents')
+                        assert response.status_code == 200
+                    gc.collect()
+                    after = tracemalloc.take_snapshot()
+                finally:
+                    tracemalloc.stop()
         
-        final_memory = process.memory_info().rss
-        memory_increase = final_memory - initial_memory
+        memory_increase = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
         
-        # Memory increase should be reasonable (less than 10MB)
-        assert memory_increase < 10 * 1024 * 1024, f"Memory increased by {memory_increase / 1024 / 1024:.2f}MB"
+        # Python allocations left behind should stay small (less than 2MB)
+        assert memory_increase < 2 * 1024 * 1024, f"Memory increased by {memory_increase / 1024 / 1024:.2f}MB"
     
     def test_cache_performance(self, app):
         """Test cache performance and efficiency"""
@@ -89,18 +107,19 @@ class TestPerformanceTests:
         
         with app.app_context():
             # First call should be slow
-            start_time = time.time()
+            start_time = time.perf_counter()
             result1 = expensive_operation(5)
-            first_call_time = time.time() - start_time
+            first_call_time = time.perf_counter() - start_time
             
             # Second call should be fast (cached)
-            start_time = time.time()
+            start_time = time.perf_counter()
             result2 = expensive_operation(5)
-            second_call_time = time.time() - start_time
+            second_call_time = time.perf_counter() - start_time
             
             assert result1 == result2 == 10
             assert call_count == 1  # Function only called once
             assert second_call_time < first_call_time * 0.1  # Cached call should be much faster
+            assert second_call_time < 1e-3
     
     def test_rate_limiter_performance(self):
         """Test rate limiter performance under load"""
@@ -110,13 +129,13 @@ class TestPerformanceTests:
             return limiter.is_allowed('test-user')
         
         # Test many rapid requests
-        start_time = time.time()
+        start_time = time.perf_counter()
         results = []
         
         for i in range(1000):
             results.append(check_rate_limit())
         
-        total_time = time.time() - start_time
+        total_time = time.perf_counter() - start_time
         
         # All requests should be allowed
         assert all(results)
@@ -124,34 +143,19 @@ class TestPerformanceTests:
         # Should handle 1000 requests quickly
         assert total_time < 1.0, f"Rate limiter took {total_time:.2f}s for 1000 requests"
     
-    def test_large_data_handling(self, client_with_session):
+    def test_large_data_handling(self, client_with_session, mock_letta, large_agent_list):
         """Test handling of large datasets"""
-        # Create large agent list
-        large_agent_list = [
-            {
-                'id': f'agent-{i}',
-                'name': f'Test Agent {i}',
-                'model': 'letta/letta-free',
-                'tags': ['user:test-user-123'],
-                'updatedAt': 1640995200000 + i
-            }
-            for i in range(1000)
-        ]
+        mock_letta.list_agents.return_value = large_agent_list
         
-        with patch('app.routes.agents.LettaClient') as mock_client:
-            mock_instance = MagicMock()
-            mock_instance.list_agents.return_value = large_agent_list
-            mock_client.return_value = mock_instance
-            
-            start_time = time.time()
-            response = client_with_session.get('/api/agents')
-            response_time = time.time() - start_time
-            
-            assert response.status_code == 200
-            assert response_time < 2.0, f"Large data response took {response_time:.2f}s"
-            
-            data = response.get_json()
-            assert len(data) == 1000
+        start_time = time.perf_counter()
+        response = client_with_session.get('/api/agents')
+        response_time = time.perf_counter() - start_time
+        
+        assert response.status_code == 200
+        assert response_time < 2.0, f"Large data response took {response_time:.2f}s"
+        
+        data = response.get_json()
+        assert len(data) == 1000
 
 class TestSecurityTests:
     """Test suite for security testing"""
@@ -172,13 +176,8 @@ class TestSecurityTests:
             assert response.status_code in [400, 404, 500]
             
             # Try SQL injection in message content
-            message_data = {
-                'messages': [
-                    {'role': 'user', 'content': payload}
-                ]
-            }
-            response = client_with_session.post('/api/agents/test-agent/messages', 
-                                             json=message_data)
+            response = client_with_session.post('/api/agents/test-agent/messages',
+                                             data=_message_body(payload), content_type='application/json')
             # Should handle gracefully
             assert response.status_code in [400, 404, 500]
     
@@ -200,18 +199,14 @@ class TestSecurityTests:
                 'memoryBlocks': [{'label': 'persona', 'value': 'test'}]
             }
             
-            response = client_with_session.put('/api/agents/test-agent', json=agent_data)
+            response = client_with_session.put('/api/agents/test-agent',
+                                            data=orjson.dumps(agent_data), content_type='application/json')
             # Should sanitize or reject
             assert response.status_code in [200, 400, 500]
             
             # Try XSS in message content
-            message_data = {
-                'messages': [
-                    {'role': 'user', 'content': payload}
-                ]
-            }
-            response = client_with_session.post('/api/agents/test-agent/messages', 
-                                             json=message_data)
+            response = client_with_session.post('/api/agents/test-agent/messages',
+                                             data=_message_body(payload), content_type='application/json')
             assert response.status_code in [200, 400, 500]
     
     def test_path_traversal_protection(self, client_with_session):
@@ -240,11 +235,11 @@ class TestSecurityTests:
         
         for malicious_input in malicious_inputs:
             if 'name' in malicious_input:
-                errors = validate_agent_data(malicious_input)
+                errors = validate_agent_data(malicious_input, first_error_only=True)
                 assert len(errors) > 0, f"Should reject malicious input: {malicious_input}"
             
             if 'messages' in malicious_input:
-                errors = validate_message_data(malicious_input)
+                errors = validate_message_data(malicious_input, first_error_only=True)
                 assert len(errors) > 0, f"Should reject malicious input: {malicious_input}"
     
     def test_session_security(self, app):
@@ -281,81 +276,85 @@ class TestSecurityTests:
         # Should work without CSRF token when disabled
         assert response.status_code in [200, 500]  # 500 if Letta server not available
     
-    def test_rate_limiting_security(self, client_with_session):
-        """Test rate limiting prevents abuse"""
-        # Make many requests quickly
-        responses = []
-        for i in range(300):  # Exceed rate limit
-            response = client_with_session.get('/api/agents')
-            responses.append(response)
-        
-        # Should eventually get rate limited
-        rate_limited_responses = [r for r in responses if r.status_code == 429]
-        assert len(rate_limited_responses) > 0, "Rate limiting should prevent abuse"
+    def test_rate_limiting_security(self, client_with_session, mock_letta, monkeypatch):
+        """Test one abusive client can't get others rate limited"""
+        # Freeze the limiter clock so no tokens refill during the test
+        monkeypatch.setattr(api_rate_limiter, 'time_fn', lambda: 0.0)
+        
+        # Spend the whole allowance of one address
+        for _ in range(api_rate_limiter.max_requests):
+            api_rate_limiter.is_allowed('10.0.0.1')
+        
+        response = client_with_session.get('/api/agents', environ_base={'REMOTE_ADDR': '10.0.0.1'})
+        assert response.status_code == 429
+        
+        # Requests from any other address are still served
+        response = client_with_session.get('/api/agents', environ_base={'REMOTE_ADDR': '10.0.0.2'})
+        assert response.status_code == 200
     
-    def test_error_information_disclosure(self, client_with_session):
+    def test_error_information_disclosure(self, client_with_session, mock_letta):
         """Test that errors don't disclose sensitive information"""
-        with patch('app.routes.agents.LettaClient') as mock_client:
-            mock_instance = MagicMock()
-            mock_instance.list_agents.side_effect = Exception('Database password: secret123')
-            mock_client.return_value = mock_instance
-            
-            response = client_with_session.get('/api/agents')
-            assert response.status_code == 500
-            
-            # Error message should not contain sensitive information
-            error_text = response.get_data(as_text=True)
-            assert 'secret123' not in error_text
-            assert 'Database password' not in error_text
+        mock_letta.list_agents.side_effect = Exception('Database password: secret123')
+        
+        response = client_with_session.get('/api/agents')
+        assert response.status_code == 500
+        
+        # Error message should not contain sensitive information
+        error_text = response.get_data(as_text=True)
+        assert 'secret123' not in error_text
+        assert 'Database password' not in error_text
 
 class TestLoadTests:
     """Test suite for load testing"""
     
     def test_concurrent_users(self, app):
         """Test application under concurrent user load"""
-        from unittest.mock import patch
+        users = 20
         
-        def simulate_user():
+        def simulate_user(_):
             with app.test_client() as client:
                 # Set test user ID directly on app
                 app._test_user_id = f'user-{threading.current_thread().ident}'
                 
-                responses = []
+                # Count completed requests, keeping no responses around
+                completed = 0
                 for i in range(10):  # 10 requests per user
-                    response = client.get('/api/agents')
-                    responses.append(response.status_code)
+                    client.get('/api/agents')
+                    completed += 1
                 
-                return responses
+                return completed
         
         # Mock the Letta client to avoid actual API calls
         with patch('app.routes.agents.LettaClient') as mock_client:
             mock_instance = mock_client.return_value
             mock_instance.get_agents.return_value = {'agents': []}
             
-            # Simulate 20 concurrent users
-            with ThreadPoolExecutor(max_workers=20) as executor:
-                futures = [executor.submit(simulate_user) for _ in range(20)]
-                results = [future.result() for future in as_completed(futures)]
+            # Simulate concurrent users, one worker each
+            with ThreadPoolExecutor(max_workers=users) as executor:
+                results = list(executor.map(simulate_user, range(users)))
         
         # All requests should complete (even if some fail)
-        assert len(results) == 20
-        for user_responses in results:
-            assert len(user_responses) == 10
+        assert results == [10] * users
     
     def test_memory_leak_detection(self, app):
         """Test for memory leaks under load"""
-        import gc
+        def make_requests(client):
+            for i in range(100):
+                response = client.get('/api/agents')
+                del response  # Explicit cleanup
         
-        def make_requests():
-            with app.test_client() as client:
-                for i in range(100):
-                    response = client.get('/api/agents')
-                    del response  # Explicit cleanup
-        
-        # Run multiple cycles
-        for cycle in range(5):
-            make_requests()
-            gc.collect()  # Force garbage collection
+        # Run multiple cycles through one client, recording what is still allocated after each
+        retained = []
+        with app.test_client() as client:
+            tracemalloc.start()
+            try:
+                for cycle in range(5):
+                    make_requests(client)
+                    gc.collect()  # Force garbage collection
+                    retained.append(tracemalloc.get_traced_memory()[0])
+            finally:
+                tracemalloc.stop()
         
-        # Memory should not grow indefinitely
-        assert True  # Placeholder - would need actual memory monitoring
+        # Memory should not grow from cycle to cycle
+        growth = retained[-1] - retained[0]
+        assert growth < 512 * 1024, f"Memory grew by {growth / 1024:.0f}KB over {len(retained) - 1} cycles"
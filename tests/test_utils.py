@@ -1,4 +1,5 @@
 import pytest
+import time
 from unittest.mock import patch, MagicMock
 from app.utils.session_manager import (
     get_user_id, get_user_tag_id, validate_agent_owner, 
@@ -7,90 +8,99 @@ from app.utils.session_manager import (
 from app.utils.validators import filter_messages, convert_to_ai_sdk_message, MESSAGE_TYPE
 from app.utils.forms import validate_agent_data, validate_message_data
 from app.utils.performance import RateLimiter, cache_result, invalidate_cache
-from datetime import datetime, timedelta
+from datetime import datetime, timezone
+
+# Session creation times as UNIX timestamps, computed once for the module
+_FRESH_TS = time.time()
+_OLD_TS = _FRESH_TS - 25 * 60 * 60
 
 class TestSessionManager:
     """Test suite for session management utilities"""
     
-    def test_get_user_id_with_authentication(self, app):
+    def test_get_user_id_with_authentication(self, app, session_ctx):
         """Test user ID retrieval with authentication enabled"""
-        with app.test_request_context():
-            with app.test_client() as client:
-                # Set test user ID
-                app._test_user_id = 'test-user-123'
-                
-                user_id = get_user_id()
-                assert user_id == 'test-user-123'
+        # Set test user ID
+        app._test_user_id = 'test-user-123'
+        
+        with session_ctx(letta_uid='test-user-123', created_at_ts=_FRESH_TS):
+            user_id = get_user_id()
+            assert user_id == 'test-user-123'
     
-    def test_get_user_id_without_authentication(self, app):
+    def test_get_user_id_without_authentication(self, app, session_ctx):
         """Test user ID retrieval with authentication disabled"""
         app.config['USE_COOKIE_BASED_AUTHENTICATION'] = False
         
-        with app.test_request_context():
+        with session_ctx():
             user_id = get_user_id()
             assert user_id == 'default'
     
-    def test_get_user_id_new_session(self, app):
+    def test_get_user_id_new_session(self, session_ctx):
         """Test user ID generation for new session"""
-        with app.test_request_context():
-            with app.test_client() as client:
-                # Don't set test user ID - should fall back to test-user-123
-                user_id = get_user_id()
-                assert user_id == 'test-user-123'
+        with session_ctx():
+            # Don't set test user ID - should fall back to test-user-123
+            user_id = get_user_id()
+            assert user_id == 'test-user-123'
     
-    def test_get_user_tag_id_with_authentication(self, app):
+    def test_get_user_tag_id_with_authentication(self, app, session_ctx):
         """Test user tag ID generation with authentication"""
-        with app.test_request_context():
-            with app.test_client() as client:
-                # Set test user ID
-                app._test_user_id = 'test-user-123'
-                
-                tags = get_user_tag_id('test-user-123')
-                assert tags == ['user:test-user-123']
+        # Set test user ID
+        app._test_user_id = 'test-user-123'
+        
+        with session_ctx(letta_uid='test-user-123'):
+            tags = get_user_tag_id('test-user-123')
+            assert tags == ['user:test-user-123']
     
-    def test_get_user_tag_id_without_authentication(self, app):
+    def test_get_user_tag_id_without_authentication(self, app, session_ctx):
         """Test user tag ID generation without authentication"""
         app.config['USE_COOKIE_BASED_AUTHENTICATION'] = False
         
-        with app.test_request_context():
+        with session_ctx():
             tags = get_user_tag_id('test-user-123')
             assert tags == []
     
-    def test_is_session_expired_fresh_session(self, app):
+    def test_is_session_expired_fresh_session(self, app, session_ctx):
         """Test session expiration check for fresh session"""
-        with app.test_request_context():
-            with app.test_client() as client:
-                # Set test user ID
-                app._test_user_id = 'test-user-123'
-                
-                # Since we're using null sessions, the function should handle the exception
-                # and return False (not expired)
-                result = is_session_expired()
-                assert result is False
+        # Set test user ID
+        app._test_user_id = 'test-user-123'
+        
+        with session_ctx(letta_uid='test-user-123', created_at_ts=_FRESH_TS):
+            # Sessions never expire in test mode
+            result = is_session_expired()
+            assert result is False
     
-    def test_is_session_expired_old_session(self, app):
+    def test_is_session_expired_old_session(self, app, session_ctx):
         """Test session expiration check for old session"""
-        with app.test_request_context():
-            with app.test_client() as client:
-                # Set test user ID
-                app._test_user_id = 'test-user-123'
-                
-                # Since we're using null sessions, the function should handle the exception
-                # and return False (not expired)
-                result = is_session_expired()
-                assert result is False
+        # Set test user ID
+        app._test_user_id = 'test-user-123'
+        
+        with session_ctx(letta_uid='test-user-123', created_at_ts=_OLD_TS):
+            # Sessions never expire in test mode
+            result = is_session_expired()
+            assert result is False
+    
+    def test_is_session_expired_outside_test_mode(self, app, session_ctx):
+        """Test session expiration is computed from the creation timestamp"""
+        app.config['TESTING'] = False
+        
+        with session_ctx(created_at_ts=_FRESH_TS):
+            assert is_session_expired() is False
+        with session_ctx(created_at_ts=_OLD_TS):
+            assert is_session_expired() is True
+        with session_ctx():
+            assert is_session_expired() is True
+        # Older sessions stored the creation time as an ISO string
+        with session_ctx(created_at=datetime.now(timezone.utc).isoformat()):
+            assert is_session_expired() is False
     
-    def test_get_session_info(self, app):
+    def test_get_session_info(self, app, session_ctx):
         """Test session info retrieval"""
-        with app.test_request_context():
-            with app.test_client() as client:
-                # Set test user ID
-                app._test_user_id = 'test-user-123'
-                
-                info = get_session_info()
-                # The function should return the test user ID from the exception handler
-                assert info['user_id'] == 'test-user-123'
-                assert info['is_authenticated'] is True
+        # Set test user ID
+        app._test_user_id = 'test-user-123'
+        
+        with session_ctx(letta_uid='test-user-123', created_at_ts=_FRESH_TS):
+            info = get_session_info()
+            assert info['user_id'] == 'test-user-123'
+            assert info['is_authenticated'] is True
     
     def test_validate_agent_owner_success(self, app):
         """Test successful agent ownership validation"""
@@ -223,8 +233,7 @@ class TestForms:
         }
         
         errors = validate_agent_data(data)
-        assert len(errors) > 0
-        assert any('Invalid model' in error for error in errors)
+        assert next((error for error in errors if 'Invalid model' in error), None) is not None
     
     def test_validate_agent_data_invalid_memory_blocks(self):
         """Test agent data validation with invalid memory blocks"""
@@ -237,8 +246,7 @@ class TestForms:
         }
         
         errors = validate_agent_data(data)
-        assert len(errors) > 0
-        assert any('must have label and value' in error for error in errors)
+        assert next((error for error in errors if 'must have label and value' in error), None) is not None
     
     def test_validate_message_data_valid(self):
         """Test valid message data validation"""
@@ -261,16 +269,26 @@ class TestForms:
         }
         
         errors = validate_message_data(data)
-        assert len(errors) > 0
-        assert any('invalid role' in error for error in errors)
+        assert next((error for error in errors if 'invalid role' in error), None) is not None
+    
+    def test_validate_message_data_first_error_only(self):
+        """Test validation can stop at the first error"""
+        data = {
+            'messages': [
+                {'role': 'invalid_role', 'content': 'Hello'},
+                {'role': 'user', 'content': 'x' * 5000}
+            ]
+        }
+        
+        assert len(validate_message_data(data)) == 2
+        assert validate_message_data(data, first_error_only=True) == ['Message 0 has invalid role: invalid_role']
     
     def test_validate_message_data_missing_messages(self):
         """Test message data validation without messages field"""
         data = {}
         
         errors = validate_message_data(data)
-        assert len(errors) > 0
-        assert any('Messages field is required' in error for error in errors)
+        assert next((error for error in errors if 'Messages field is required' in error), None) is not None
 
 class TestPerformance:
     """Test suite for performance utilities"""
@@ -304,6 +322,37 @@ class TestPerformance:
         remaining = limiter.get_remaining_requests('test-user')
         assert remaining == 3
     
+    def test_rate_limiter_refills_over_window(self):
+        """Test rate limiter allows a burst up to max_requests, then refills over the window"""
+        now = [0.0]
+        limiter = RateLimiter(max_requests=30, window_seconds=60, time_fn=lambda: now[0])
+        
+        for i in range(30):
+            assert limiter.is_allowed('test-user')
+        
+        # Bucket is empty until time passes
+        assert not limiter.is_allowed('test-user')
+        assert not limiter.is_allowed('test-user')
+        
+        # One request refills every 2 seconds
+        now[0] += 2
+        assert limiter.is_allowed('test-user')
+        assert not limiter.is_allowed('test-user')
+    
+    @pytest.mark.parametrize('elapsed, expected', [(7, 3), (1000, 30)], ids=['partial', 'capped'])
+    def test_rate_limiter_remaining_matches_allowed(self, elapsed, expected):
+        """Test get_remaining_requests refills exactly like is_allowed"""
+        now = [0.0]
+        limiter = RateLimiter(max_requests=30, window_seconds=60, time_fn=lambda: now[0])
+        for i in range(30):
+            limiter.is_allowed('test-user')
+        
+        now[0] += elapsed
+        assert limiter.get_remaining_requests('test-user') == expected
+        for i in range(expected):
+            assert limiter.is_allowed('test-user')
+        assert not limiter.is_allowed('test-user')
+    
     def test_cache_result_caching(self, app):
         """Test result caching functionality"""
         call_count = 0
@@ -327,8 +376,12 @@ class TestPerformance:
     
     def test_invalidate_cache(self, app):
         """Test cache invalidation"""
+        call_count = 0
+        
         @cache_result(ttl=60)
         def test_function(x):
+            nonlocal call_count
+            call_count += 1
             return x * 2
         
         with app.app_context():
@@ -339,13 +392,83 @@ class TestPerformance:
             invalidate_cache('test_function')
             
             # Next call should not use cache
-            call_count = 0
-            def counting_function(x):
-                nonlocal call_count
-                call_count += 1
-                return x * 2
+            assert test_function(5) == 10
+            assert call_count == 2
+    
+    def test_cache_result_expires_after_ttl(self, app, monkeypatch):
+        """Test cached results are recomputed once the TTL has passed"""
+        now = [1000.0]
+        monkeypatch.setattr('app.utils.performance.time.monotonic', lambda: now[0])
+        call_count = 0
+        
+        @cache_result(ttl=60)
+        def test_function(x):
+            nonlocal call_count
+            call_count += 1
+            return x
+        
+        with app.app_context():
+            # Unhashable arguments bypass the cache
+            test_function([1])
+            test_function([1])
+            assert call_count == 2
             
-            # This would require modifying the decorator to track calls
-            # For now, just test that invalidate_cache doesn't crash
-            invalidate_cache('test_function')
-            assert True  # If we get here, no exception was raised
+            test_function(5)
+            now[0] += 59
+            test_function(5)
+            assert call_count == 3
+            
+            now[0] += 1
+            test_function(5)
+            assert call_count == 4
+    
+    def test_cache_result_stays_within_maxsize(self, app):
+        """Test evicted results stop counting towards the cache stats"""
+        call_count = 0
+        
+        @cache_result(ttl=60, maxsize=8)
+        def test_function(x):
+            nonlocal call_count
+            call_count += 1
+            return x
+        
+        with app.app_context():
+            for i in range(100):
+                test_function(i)
+            assert test_function.cache_stats() == (8, 0)
+            
+            # The oldest results were evicted, the newest are still cached
+            test_function(99)
+            assert call_count == 100
+            test_function(0)
+            assert call_count == 101
+            assert test_function.cache_stats() == (8, 0)
+
+class TestJSONProvider:
+    """Test suite for the orjson JSON provider"""
+    
+    def test_orjson_provider_round_trip(self, app):
+        """Test jsonify output matches Flask's default provider"""
+        pytest.importorskip('orjson')
+        from flask.json.provider import DefaultJSONProvider
+        from app.utils.json_provider import OrjsonProvider
+        assert isinstance(app.json, OrjsonProvider)
+        
+        data = {'b': [1, 2.5, None], 'a': 'héllo', 'when': datetime(2022, 1, 1, 12, 0)}
+        with app.test_request_context():
+            response = app.json.response(data)
+            assert response.mimetype == 'application/json'
+            assert response.get_json() == DefaultJSONProvider(app).loads(DefaultJSONProvider(app).dumps(data))
+            assert response.get_json()['when'] == 'Sat, 01 Jan 2022 12:00:00 GMT'
+            # Keys are sorted like the default provider
+            assert list(response.get_json()) == ['a', 'b', 'when']
+    
+    def test_orjson_provider_fallback_keeps_indent(self, app):
+        """Test options orjson lacks fall back to the default provider with indent intact"""
+        pytest.importorskip('orjson')
+        from flask.json.provider import DefaultJSONProvider
+        
+        data = {'b': 1, 'a': [1, 2]}
+        expected = DefaultJSONProvider(app).dumps(data, indent=2, sort_keys=False)
+        assert app.json.dumps(data, indent=2, sort_keys=False) == expected
+        assert '\n  "b": 1' in expected